@@ -2,12 +2,11 @@ import json
 from os.path import exists
 import numpy as np
 from sklearn.linear_model import Ridge
-from sklearn.metrics import make_scorer
-from sklearn.model_selection import GridSearchCV, KFold
-from scipy.stats import rankdata, zscore
-from scipy.spatial.distance import cdist
+from sklearn.model_selection import KFold
+from scipy.stats import zscore
 from gifti_io import read_gifti, write_gifti
-from split_stories import check_keys, load_split_data, split_models
+from split_stories import (check_keys, load_split_data, split_models,
+                           standardize_rows)
 from brainiak.utils.utils import array_correlation
 
 
@@ -72,20 +71,32 @@ def aggregate_subjects(datasets, models, story_list, subject_list,
 
 
 # Function to compute correlation-based rank accuracy
-def rank_accuracy(predicted_model, test_model, mean=True):
+def rank_accuracy(predicted_model, test_model, mean=True, block_size=1024):
     n_predictions = test_model.shape[0]
 
-    # Get correlations between pairs
-    correlations = 1 - cdist(predicted_model, test_model,
-                             'correlation')
+    # Standardize each prediction and test sample across features
+    predicted_model = standardize_rows(predicted_model)
+    test_model = standardize_rows(test_model)
 
-    # Get rank of matching prediction for each
-    ranks = []
-    for index in np.arange(n_predictions):
-        ranks.append(rankdata(correlations[index])[index])
+    # Get correlations between pairs in blocks of predictions
+    ranks = np.empty(n_predictions)
+    for start in np.arange(0, n_predictions, block_size):
+        correlations = (predicted_model[start:start + block_size] @
+                        test_model.T)
+
+        # Get (average tied) rank of matching prediction for each
+        rows = np.arange(correlations.shape[0])
+        matching = correlations[rows, rows + start, np.newaxis]
+        ranks[start:start + block_size] = (
+            np.sum(correlations < matching, axis=1) +
+            (np.sum(correlations == matching, axis=1) + 1) / 2)
+
+        # Propagate NaNs as rankdata would
+        ranks[start:start + block_size][
+            np.any(np.isnan(correlations), axis=1)] = np.nan
 
     # Normalize ranks by number of choices
-    ranks = (np.array(ranks) - 1) / (n_predictions - 1)
+    ranks = (ranks - 1) / (n_predictions - 1)
 
     if mean:
         ranks = np.mean(ranks)
@@ -93,42 +104,67 @@ def rank_accuracy(predicted_model, test_model, mean=True):
     return ranks
 
 
-# Function to run grid search over alphas across voxels
-def grid_search(train_model, train_data, alphas, scorer, n_splits=10):
+# Function to fit multi-output ridge regression via SVD
+def ridge_svd(train_model, train_data, alpha, fit_intercept=True):
 
-    # Get number of voxels
-    n_voxels = train_data.shape[1]
+    # Center model and data to fit intercept
+    if fit_intercept:
+        model_mean = np.mean(train_model, axis=0)
+        data_mean = np.mean(train_data, axis=0)
+        train_model = train_model - model_mean
+        train_data = train_data - data_mean
 
-    # Set up ridge regression
-    ridge = Ridge(fit_intercept=True, normalize=False,
-                  copy_X=True, tol=0.001)
+    # Ridge solution for all targets via shrunken singular values
+    U, S, Vt = np.linalg.svd(train_model, full_matrices=False)
+    D = S / (S ** 2 + alpha)
+    coef = Vt.T @ (D[:, np.newaxis] * (U.T @ train_data))
 
-    # Set up grid search
-    grid = GridSearchCV(ridge, {'alpha': alphas}, iid=False,
-                        scoring=scorer,
-                        cv=KFold(n_splits=n_splits), refit=False,
-                        return_train_score=False)
+    # Recover intercept from means
+    if fit_intercept:
+        intercept = data_mean - model_mean @ coef
+    else:
+        intercept = np.zeros(coef.shape[1])
 
-    # Loop through voxels
-    best_alphas, best_scores, all_scores = [], [], []
-    for voxel in np.arange(n_voxels):
+    # Return coefficients as targets by features
+    return coef.T, intercept
 
-        # Perform grid search over alphas for voxel
-        grid.fit(train_model, train_data[:, voxel]);
 
-        best_alphas.append(grid.best_params_['alpha'])
-        best_scores.append(grid.best_score_)
-        
-        # Get all scores across folds
-        split_scores = []
-        for split in np.arange(n_splits):
-            split_score = grid.cv_results_[f'split{split}_test_score']
-            split_scores.append(split_score)
-        all_scores.append(np.mean(split_scores, axis=0))
+# Function to run grid search over alphas across voxels
+def grid_search(train_model, train_data, alphas, scorer=array_correlation,
+                n_splits=10):
+
+    # Get number of voxels
+    n_voxels = train_data.shape[1]
 
-    best_alphas = np.array(best_alphas)
-    best_scores = np.array(best_scores)
-    all_scores = np.column_stack(all_scores)
+    # Loop through folds, scoring all alphas and voxels at once
+    split_scores = []
+    for train, test in KFold(n_splits=n_splits).split(train_model):
+
+        # Center training fold to fit intercept
+        model_mean = np.mean(train_model[train], axis=0)
+        data_mean = np.mean(train_data[train], axis=0)
+        model_train = train_model[train] - model_mean
+        data_train = train_data[train] - data_mean
+        model_test = train_model[test] - model_mean
+
+        # Single SVD of training fold shared across alphas and voxels
+        U, S, Vt = np.linalg.svd(model_train, full_matrices=False)
+        UtY = U.T @ data_train
+
+        # Ridge solution for each alpha via shrunken singular values
+        alpha_scores = []
+        for alpha in alphas:
+            D = S / (S ** 2 + alpha)
+            coef = Vt.T @ (D[:, np.newaxis] * UtY)
+            predicted = model_test @ coef + data_mean
+            alpha_scores.append(scorer(predicted, train_data[test]))
+        split_scores.append(alpha_scores)
+
+    # Average scores across folds and find best alpha per voxel
+    all_scores = np.mean(split_scores, axis=0)
+    best_indices = np.argmax(all_scores, axis=0)
+    best_alphas = np.array(alphas)[best_indices]
+    best_scores = all_scores[best_indices, np.arange(n_voxels)]
 
     assert (best_alphas.shape[0] == best_scores.shape[0]
             == all_scores.shape[1] == n_voxels)
@@ -166,9 +202,6 @@ if __name__ == '__main__':
     story_train = 'all'
     alpha = 100
 
-    # Make custom correlation scorer
-    correlation_scorer = make_scorer(array_correlation)
-
     # Populate results file if it already exists
     results_fn = f'data/encoding_{story_train}-story_avg_inv_results.npy'
     if exists(results_fn):
@@ -257,18 +290,13 @@ if __name__ == '__main__':
                                 test_data = np.expand_dims(np.mean(test_data,
                                                                     axis=1), 1)
                                 
-                            # Declare ridge regression model
-                            ridge = Ridge(alpha=alpha, fit_intercept=True, normalize=False,
-                                          copy_X=True, tol=0.001, solver='auto')
-
-                            # Fit training data
-                            ridge.fit(train_model, train_data)
-
-                            # Get coefficients of trained model
-                            coefficients = ridge.coef_
+                            # Fit ridge regression to training data
+                            coefficients, intercept = ridge_svd(train_model,
+                                                                train_data,
+                                                                alpha)
 
                             # Use trained model to predict response for test data
-                            predicted_data = ridge.predict(test_model)
+                            predicted_data = test_model @ coefficients.T + intercept
 
                             # Compute correlation between predicted and test response
                             performance = array_correlation(predicted_data,
@@ -284,14 +312,15 @@ if __name__ == '__main__':
                             if prefix[0] != 'no SRM (average)':
                                 
                                 # Collapse coefficients across delays for decoding
-                                collapse_coef = np.mean(np.split(ridge.coef_, len(delays),
-                                                                 axis=1), axis=0)
-                                collapse_test_model = np.mean(np.split(test_model, len(delays),
-                                                                axis=1), axis=0)
+                                collapse_coef = coefficients.reshape(
+                                    coefficients.shape[0], len(delays), -1).mean(axis=1)
+                                collapse_test_model = test_model.reshape(
+                                    test_model.shape[0], len(delays), -1).mean(axis=1)
                                 
-                                predicted_model = Ridge(alpha=alpha,
-                                                        fit_intercept=False).fit(collapse_coef,
-                                                                                 test_data.T).coef_
+                                predicted_model = Ridge(alpha=alpha, fit_intercept=False,
+                                                        solver='cholesky',
+                                                        copy_X=False).fit(collapse_coef,
+                                                                          test_data.T).coef_
                                 raise
 
                                 accuracy = rank_accuracy(predicted_model, collapse_test_model)
@@ -1,12 +1,44 @@
+from os import remove, replace
+from os.path import getmtime, isfile
 import numpy as np
 import nibabel as nib
 
 
 # Function to read in GIfTI file as np.ndarray
-def read_gifti(gifti_fn):
+def read_gifti(gifti_fn, cache=False):
+
+    # Optionally memory-map array cached alongside GIfTI
+    cache_fn = gifti_fn + '.npy'
+    if (cache and isfile(cache_fn) and
+            getmtime(cache_fn) >= getmtime(gifti_fn)):
+
+        # Treat an unreadable cache as a miss and re-parse GIfTI
+        try:
+            return np.load(cache_fn, mmap_mode='c')
+        except (OSError, ValueError, EOFError):
+            print(f"Couldn't read cache {cache_fn}, re-parsing GIfTI")
+
     gii = nib.load(gifti_fn)
     data = np.vstack([da.data[np.newaxis, :]
                       for da in gii.darrays]) 
+
+    # Cache array to skip GIfTI parsing on later reads, writing to
+    # temporary file first so cache is either complete or absent
+    if cache:
+        temp_fn = cache_fn + '.tmp.npy'
+        try:
+            np.save(temp_fn, data)
+            replace(temp_fn, cache_fn)
+
+        # Fall back to parsed array if cache can't be written
+        except OSError:
+            print(f"Couldn't write cache {cache_fn}!!!")
+            if isfile(temp_fn):
+                try:
+                    remove(temp_fn)
+                except OSError:
+                    pass
+
     return data
 
 
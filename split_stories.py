@@ -1,24 +1,38 @@
 import json
 from os.path import exists, join
 import numpy as np
-from scipy.stats import zscore
 from gifti_io import read_gifti
 
 
+# Z-score columns in place (matching scipy.stats.zscore with ddof=0)
+def zscore_inplace(data):
+    np.subtract(data, np.mean(data, axis=0), out=data)
+    data /= np.std(data, axis=0)
+
+    return data
+
+
+# Center rows and scale to unit norm so dot products are correlations
+def standardize_rows(data):
+    data = data - np.mean(data, axis=1, keepdims=True)
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+
+    return data
+
+
 # Function for delaying model embedding by several TRs
 def delay_model(model, delays=[2, 3, 4, 5]):
 
-    # Horizontally stack semantic vectors at varying delays
-    delayed = []
-    for delay in delays:
-        delayed.append(np.vstack((np.full((delay,
-                                           model.shape[1]),
-                                          np.nan),
-                                  model[:-delay])))
-    delayed = np.hstack(delayed)
+    # Fill zero-padded buffer with semantic vectors at varying delays
+    n_TRs, n_features = model.shape
+    delayed = np.zeros((n_TRs, n_features * len(delays)),
+                       dtype=model.dtype)
+    for i, delay in enumerate(delays):
+        delayed[delay:, i * n_features:(i + 1) * n_features] = (
+            model[:n_TRs - delay])
 
     # Zero out any NaNs in delayed embedding
-    delayed[np.isnan(delayed)] = 0
+    np.nan_to_num(delayed, copy=False)
 
     return delayed
 
@@ -35,8 +49,8 @@ def split_models(metadata, stories=None, subjects=None, half=1,
     model_splits = {}
     for story in stories:
 
-        # Get model
-        model = np.load(metadata[story]['model'])
+        # Get model (memory-mapped, so only used rows are read)
+        model = np.load(metadata[story]['model'], mmap_mode='c')
 
         # Trim model
         model_trims = metadata[story]['model_trims']
@@ -52,7 +66,7 @@ def split_models(metadata, stories=None, subjects=None, half=1,
 
         # Optionally z-score model features
         if zscore_model:
-            half_model = zscore(half_model, axis=0)
+            half_model = zscore_inplace(half_model)
 
         # Horizontally stack delayed replicates of model
         half_model = delay_model(half_model, delays=delays)
@@ -67,7 +81,8 @@ def split_models(metadata, stories=None, subjects=None, half=1,
 # Split into first and second half for train/test and save
 def split_data(metadata, stories=None, subjects=None,
                hemisphere=None, zscore_data=True,
-               mask=None, roi=None, save_files=True):
+               mask=None, roi=None, save_files=True,
+               cache_gifti=False):
 
     # By default grab all stories in metadata
     stories = check_keys(metadata, keys=stories)
@@ -96,7 +111,7 @@ def split_data(metadata, stories=None, subjects=None,
 
                 # Load in data from GIfTI
                 data_fn = metadata[story]['data'][subject][hemi]
-                surf_data = read_gifti(data_fn)
+                surf_data = read_gifti(data_fn, cache=cache_gifti)
 
                 # Optionally mask
                 if mask and roi:
@@ -112,8 +127,8 @@ def split_data(metadata, stories=None, subjects=None,
                 half2_data = surf_data[midpoint:, :]
 
                 if zscore_data:
-                    half1_data = zscore(half1_data, axis=0)
-                    half2_data = zscore(half2_data, axis=0)
+                    half1_data = zscore_inplace(half1_data)
+                    half2_data = zscore_inplace(half2_data)
 
                 if save_files:
                     if mask and roi:
@@ -229,7 +244,7 @@ if __name__ == '__main__':
     
     split_data(metadata, stories=stories, subjects=None,
                hemisphere=None, zscore_data=True,
-               save_files=True)
+               save_files=True, cache_gifti=True)
 
     # Split data into ROIs   
     rois = ['EAC', 'AAC', 'TPOJ', 'PMC']
@@ -240,4 +255,5 @@ if __name__ == '__main__':
 
         split_data(metadata, stories=stories, subjects=None,
                    hemisphere=None, zscore_data=True,
-                   mask=mask, roi=f'{roi}_noSRM', save_files=True)
+                   mask=mask, roi=f'{roi}_noSRM', save_files=True,
+                   cache_gifti=True)
@@ -1,5 +1,6 @@
 import json
 import numpy as np
+from scipy.linalg import get_blas_funcs
 from scipy.stats import zscore
 from brainiak.isc import isc, isfc
 from brainiak.funcalign.srm import SRM
@@ -297,10 +298,17 @@ def target_wsfc(data, targets, stories=None, subjects=None,
 
             # Compute WSFCs between ROI and targets
             wsfcs = []
+            n_TRs = data_stack.shape[0]
             for s in np.arange(data_stack.shape[2]):
-                d = data_stack[..., s].shape[1]
-                wsfc = np.corrcoef(data_stack[..., s].T,
-                                   target_stack[..., s].T)[:d, d:]
+
+                # Standardize time series so GEMM yields correlations
+                data_z = zscore(data_stack[..., s], axis=0)
+                target_z = zscore(target_stack[..., s], axis=0)
+
+                # Transposed views are Fortran-ordered for BLAS
+                gemm = get_blas_funcs('gemm', (data_z, target_z))
+                wsfc = gemm(1 / n_TRs, data_z.T, target_z.T,
+                            trans_b=True)
                 wsfcs.append(np.expand_dims(wsfc, 0))
             wsfcs = np.vstack(wsfcs)
 
@@ -1,8 +1,11 @@
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from os.path import exists
 import numpy as np
+from threadpoolctl import threadpool_limits
 from brainiak.isc import isc
-from split_stories import check_keys, load_split_data
+from split_stories import check_keys, load_split_data, standardize_rows
 
 
 # Function to split time series data into segements
@@ -13,49 +16,60 @@ def time_segmentation(data, segment_length, average=False):
     n_segments = n_TRs // segment_length
     modulo = n_TRs % n_segments
 
-    # If even division, split and optionally average
-    if modulo == 0:
-        if average:
-            segments = np.vstack([np.mean(segment, axis=0) for segment in
-                                  np.array_split(data, n_segments,
-                                       axis=0)])            
-        else:
-            segments = np.vstack([np.ravel(segment) for segment in
-                                  np.array_split(data, n_segments,
-                                       axis=0)])
-
-    # If modulo, trim modulo off end before splitting
+    # Trim modulo off end and reshape into equal segments
+    segments = data[:n_TRs - modulo, ...].reshape(n_segments, -1,
+                                                  *data.shape[1:])
+
+    # Optionally average within segments, otherwise flatten
+    if average:
+        segments = np.mean(segments, axis=1)
     else:
-        if average:
-            segments = np.vstack([np.mean(segment, axis=0) for segment in
-                      np.array_split(data[:-modulo, ...], n_segments,
-                           axis=0)])
-        else:
-            segments = np.vstack([np.ravel(segment) for segment in
-                                  np.array_split(data[:-modulo, ...], n_segments,
-                                       axis=0)])
+        segments = segments.reshape(n_segments, -1)
+
     return segments
 
 
-# Compute intersubject time-segment pattern correlations
-def time_segment_correlation(data, segment_length, average=False):
+# Sum and count non-NaN values across subjects for leave-one-out averages
+def nan_sums(data):
+    total = np.nansum(data, axis=0)
+    counts = np.sum(~np.isnan(data), axis=0, dtype=data.dtype)
+
+    return total, counts
+
+
+# Compute average time series of others leaving one subject out
+def leave_one_out(data, i_subject, sums=None):
+
+    # Optionally reuse precomputed sums and counts
+    if sums is None:
+        sums = nan_sums(data)
+    total, counts = sums
+
+    # Leave subject out of sum and count
+    subject = data[i_subject]
+    with np.errstate(invalid='ignore'):
+        others = ((total - np.nan_to_num(subject)) /
+                  (counts - ~np.isnan(subject)))
+
+    return others
 
-    n_TRs, n_voxels, n_subjects = data.shape
+
+# Standardized time segments for each subject and average of others
+def segment_patterns(data, segment_length, average=False, sums=None):
+
+    n_subjects, n_TRs, n_voxels = data.shape
     n_segments = n_TRs // segment_length
 
-    # For each subject, get correlation with average of others
-    correlations = []
-    for i_subject in np.arange(n_subjects):
+    # Sum and count across subjects once (unless provided)
+    if sums is None:
+        sums = nan_sums(data)
 
-        # Time series for one subject
-        subject = data[..., i_subject]
+    # For each subject, yield segments with average of others
+    for i_subject in np.arange(n_subjects):
 
-        # Compute average time series of others
-        others = np.dstack([data[..., i_other]
-                            for i_other in np.arange(n_subjects)
-                            if i_other != i_subject])
-        assert others.shape[2] == n_subjects - 1
-        others = np.nanmean(others, axis=2)
+        # Time series for one subject and average of others
+        subject = data[i_subject]
+        others = leave_one_out(data, i_subject, sums=sums)
 
         # Perform time series segmentation
         subject_segments = time_segmentation(subject,
@@ -68,57 +82,164 @@ def time_segment_correlation(data, segment_length, average=False):
         assert (n_segments == subject_segments.shape[0] ==
                 others_segments.shape[0])
 
-        # Compute pairwise cross-subject correlations
-        correlations.append(np.corrcoef(subject_segments,
-                                        others_segments)[:n_segments,
-                                                         n_segments:])
+        # Standardize segments across features
+        subject_segments = standardize_rows(subject_segments)
+        others_segments = standardize_rows(others_segments)
+
+        yield subject_segments, others_segments
+
+
+# Compute intersubject time-segment pattern correlations
+def time_segment_correlation(data, segment_length, average=False,
+                             sums=None):
+
+    # Compute pairwise cross-subject correlations for each subject
+    correlations = [subject_segments @ others_segments.T
+                    for subject_segments, others_segments
+                    in segment_patterns(data, segment_length,
+                                        average=average, sums=sums)]
 
-    return np.dstack(correlations)
+    return np.stack(correlations, axis=2)
+
+
+# Classify time segments without storing full correlation matrices
+def time_segment_classification(data, segment_length, average=False,
+                                block_size=256, sums=None):
+
+    n_segments = data.shape[1] // segment_length
+
+    # For each subject, correlate blocks of segments with others
+    accuracies = []
+    for subject_segments, others_segments in segment_patterns(
+            data, segment_length, average=average, sums=sums):
+        n_hits = 0
+        for start in np.arange(0, n_segments, block_size):
+            block = (subject_segments[start:start + block_size] @
+                     others_segments.T)
+
+            # Compare diagonal correlation with off-diagonal in block
+            rows = np.arange(block.shape[0])
+            diagonal = block[rows, rows + start]
+            block[rows, rows + start] = -np.inf
+            n_hits += np.sum(diagonal > np.amax(block, axis=1))
+
+        accuracies.append(n_hits / n_segments)
+
+    accuracies = np.array(accuracies)
+    chance = 1/n_segments
+
+    return accuracies, chance
 
 
 # Classify time segments based on correlation
 def correlation_classification(correlations):
-    accuracies = []
     n_segments = correlations.shape[0]
 
     # For each time point compare diagonal correlation with off-diaogonal
-    for correlation in np.moveaxis(correlations, 2, 0):
-        n_hits = 0
-        for i, row in enumerate(correlation):
-            diagonal = row[i]
-            if diagonal > np.amax([row[off] for off in
-                                   np.arange(len(row)) if
-                                   off != i]):
-                n_hits += 1
-        accuracies.append(n_hits / n_segments)
+    diagonal = np.einsum('iis->is', correlations)
+    off_diagonal = np.where(np.eye(n_segments, dtype=bool)[..., np.newaxis],
+                            -np.inf, correlations)
+    hits = diagonal > np.amax(off_diagonal, axis=1)
 
-    accuracies = np.array(accuracies)
+    accuracies = np.mean(hits, axis=0)
     chance = 1/n_segments
 
     return accuracies, chance
 
 
+# Compute leave-one-out temporal ISCs for each subject and voxel
+def temporal_isc(data, sums=None):
+
+    n_subjects, n_TRs, n_voxels = data.shape
+
+    # Sum and count across subjects once (unless provided)
+    if sums is None:
+        sums = nan_sums(data)
+
+    # Correlate each subject's voxel time series with average of others
+    # (accumulating in double precision to match brainiak's output)
+    iscs = np.empty((n_subjects, n_voxels), dtype=np.float64)
+    for i_subject in np.arange(n_subjects):
+        subject = data[i_subject] - np.mean(data[i_subject], axis=0)
+        others = leave_one_out(data, i_subject, sums=sums)
+        others -= np.mean(others, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            iscs[i_subject] = (
+                np.einsum('tv,tv->v', subject, others, dtype=np.float64) /
+                np.sqrt(np.einsum('tv,tv->v', subject, subject,
+                                  dtype=np.float64) *
+                        np.einsum('tv,tv->v', others, others,
+                                  dtype=np.float64)))
+
+    return iscs
+
+
 # Convenience function stack subjects into array
 def stack_subjects(data, subjects=None, hemisphere='lh'):
 
     # By default just grab all subjects
     subject_list = check_keys(data, keys=subjects)
 
-    subject_stack = np.dstack([data[subject][hemisphere] for
-                               subject in subject_list])
+    # Stack subjects first in single precision
+    subject_stack = np.stack([data[subject][hemisphere] for
+                              subject in subject_list],
+                             axis=0).astype(np.float32, copy=False)
 
-    assert subject_stack.shape[2] == len(subject_list)
+    assert subject_stack.shape[0] == len(subject_list)
 
     return subject_stack
 
 
-# Name guard for when we actually want to split all daata
-if __name__ == '__main__':
+# Load and stack subjects for story, reusing repeated loads
+@lru_cache(maxsize=64)
+def load_stack(story, hemisphere, prefix, metadata_fn='data/metadata.json'):
 
     # Load dictionary of input filenames and parameters
-    with open('data/metadata.json') as f:
+    with open(metadata_fn) as f:
         metadata = json.load(f)
 
+    # Load in either raw data with mask or SRM ROI data
+    data = load_split_data(metadata, stories=story, subjects=None,
+                           hemisphere=hemisphere, half=2, prefix=prefix)
+
+    # Stack subjects
+    subject_stack = stack_subjects(data[story], subjects=None,
+                                   hemisphere=hemisphere)
+
+    # Protect cached array from in-place modification
+    subject_stack.flags.writeable = False
+
+    return subject_stack
+
+
+# Limit each worker process to a single BLAS thread
+def limit_blas_threads():
+    threadpool_limits(limits=1, user_api='blas')
+
+
+# Run time-segment classification for one story, ROI, prefix, and hemisphere
+def run_classification(task, segment_length, average=False):
+    story, roi, prefix, hemi = task
+
+    # Load stacked subject data, bypassing cache since tasks are unique
+    subject_stack = load_stack.__wrapped__(story, hemi,
+                                           f'{roi}_' + prefix[1])
+
+    # Get the regional average as well
+    if prefix[0] == 'no SRM (average)':
+        subject_stack = np.expand_dims(np.mean(subject_stack,
+                                               axis=2), 2)
+
+    # Classify time segments based on correlations
+    accuracies, chance = time_segment_classification(
+        subject_stack, segment_length, average=average)
+
+    return task, accuracies
+
+
+# Name guard for when we actually want to split all daata
+if __name__ == '__main__':
+
     # Create story and subject lists
     stories = ['pieman', 'prettymouth', 'milkyway',
                'slumlordreach', 'notthefall', '21styear',
@@ -128,6 +249,9 @@ if __name__ == '__main__':
     segment_length = 10
     average = False
 
+    # Number of worker processes (each limited to one BLAS thread)
+    max_workers = 8
+
     rois = ['EAC', 'AAC', 'TPOJ', 'PMC']
     prefixes = [('no SRM', 'noSRM'),
                 ('no SRM (average)', 'noSRM'),
@@ -146,7 +270,11 @@ if __name__ == '__main__':
     else:
         results = {}
 
+    # Checkpoint results after this many completed tasks
+    checkpoint_every = 10
+
     # Loop through keys without replacing existing ones
+    tasks = []
     for story in stories:
         if story not in results:
             results[story] = {}
@@ -164,36 +292,35 @@ if __name__ == '__main__':
 
                 for hemi in hemis:
                     if hemi not in results[story][roi][prefix[0]]:
-                        results[story][roi][prefix[0]][hemi] = {}
-
-                        # Load in either raw data with mask or SRM ROI data
-                        data = load_split_data(metadata, stories=story,
-                                               subjects=None,
-                                               hemisphere=hemi,
-                                               half=2, prefix=f'{roi}_' + prefix[1])
-
-                        # Depth-stack subjects
-                        subject_stack = stack_subjects(data[story],
-                                                       subjects=None,
-                                                       hemisphere=hemi)
-                        
-                        # Get the regional average as well
-                        if prefix[0] == 'no SRM (average)':
-                            subject_stack = np.expand_dims(np.mean(subject_stack,
-                                                               axis=1), 1)
-
-                        # Compute paired time-segment correlations
-                        correlations = time_segment_correlation(subject_stack,
-                                                                segment_length,
-                                                                average=average)
-
-                        # Classify time segments based on correlations
-                        accuracies, chance = correlation_classification(correlations)
-
-                        results[story][roi][prefix[0]][hemi] = accuracies
-                        print("Finished computing time-segment "
-                              f"classification for {story}, "
-                              f"{roi}, {prefix[0]}, {hemi}")
+                        tasks.append((story, roi, prefix, hemi))
+
+    # Run independent classification tasks across processes
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=limit_blas_threads) as executor:
+        futures = {executor.submit(run_classification, task,
+                                   segment_length, average=average): task
+                   for task in tasks}
+
+        for n_done, future in enumerate(as_completed(futures), 1):
+            story, roi, prefix, hemi = futures[future]
+
+            # Skip failed tasks so other results are kept (and retried later)
+            try:
+                _, accuracies = future.result()
+            except Exception as error:
+                print("Failed computing time-segment "
+                      f"classification for {story}, "
+                      f"{roi}, {prefix[0]}, {hemi}: {error!r}")
+                continue
+
+            results[story][roi][prefix[0]][hemi] = accuracies
+            print("Finished computing time-segment "
+                  f"classification for {story}, "
+                  f"{roi}, {prefix[0]}, {hemi}")
+
+            # Periodically checkpoint completed results
+            if n_done % checkpoint_every == 0:
+                np.save(results_fn, results)
 
     np.save(results_fn, results)
 
@@ -229,35 +356,44 @@ if __name__ == '__main__':
                 if prefix[0] not in results[story][roi]:
                     results[story][roi][prefix[0]] = {}
 
-                for hemi in hemis:
-                    if hemi not in results[story][roi][prefix[0]]:
-                        results[story][roi][prefix[0]][hemi] = {}
-
-                    # Load in either raw data with mask or SRM ROI data
-                    data = load_split_data(metadata, stories=story,
-                                           subjects=None,
-                                           hemisphere=hemi,
-                                           half=2, prefix=f'{roi}_' + prefix[1])
-
-                    # Depth-stack subjects
-                    subject_stack = stack_subjects(data[story],
-                                                   subjects=None,
-                                                   hemisphere=hemi)
-                    
+        for hemi in hemis:
+
+            # Collect stacked subject data across ROIs and prefixes
+            keys, stacks = [], []
+            for roi in rois:
+                for prefix in prefixes:
+
+                    # Load (or reuse) stacked subject data
+                    subject_stack = load_stack(story, hemi,
+                                               f'{roi}_' + prefix[1])
+
                     # Get the regional average as well
                     if prefix[0] == 'no SRM (average)':
                         subject_stack = np.expand_dims(np.mean(subject_stack,
-                                                               axis=1), 1)
-                        
-
-                    # Compute paired time-segment correlations
-                    if isc_type == 'temporal':
-                        iscs = isc(subject_stack)
-                    elif isc_type == 'spatial':
-                        iscs = isc(np.moveaxis(subject_stack, 1, 0))
-
-                    results[story][roi][prefix[0]][hemi] = iscs
-                    print(f"Finished computing {isc_type} ISCs for {story}, "
-                          f"{roi}, {prefix[0]}, {hemi}")
+                                                               axis=2), 2)
+
+                    keys.append((roi, prefix[0]))
+                    stacks.append(subject_stack)
+
+            # Compute temporal ISCs in one batch along voxels, then unstack
+            if isc_type == 'temporal':
+                offsets = np.cumsum([0] + [stack.shape[2]
+                                           for stack in stacks])
+                batch_iscs = temporal_isc(np.concatenate(stacks, axis=2))
+                iscs = [batch_iscs[:, start:end] for start, end
+                        in zip(offsets[:-1], offsets[1:])]
+
+            # Spatial ISCs are computed across voxels within each ROI
+            elif isc_type == 'spatial':
+                iscs = [isc(np.transpose(stack, (2, 1, 0)))
+                        for stack in stacks]
+
+            for (roi, label), roi_iscs in zip(keys, iscs):
+                results[story][roi][label][hemi] = roi_iscs
+                print(f"Finished computing {isc_type} ISCs for {story}, "
+                      f"{roi}, {label}, {hemi}")
+
+            # Checkpoint results after each hemisphere
+            np.save(results_fn, results)
 
     np.save(results_fn, results)